@@ -1,7 +1,67 @@
+import datetime
 import os
-import pickle
+from threading import Lock
 
-from pymemcache.client import base
+import cachetools
+import msgpack
+from pymemcache.client.hash import HashClient
+
+EXT_DATETIME = 1
+
+
+def _default(obj):
+    if isinstance(obj, datetime.datetime):
+        return msgpack.ExtType(EXT_DATETIME, obj.isoformat().encode())
+    raise TypeError(f"Cannot serialize {type(obj)!r}")
+
+
+def _ext_hook(code, data):
+    if code == EXT_DATETIME:
+        return datetime.datetime.fromisoformat(data.decode())
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackSerde:
+    """ Serializes cached values with msgpack inside the memcached client """
+
+    def serialize(self, key, value):
+        return msgpack.packb(value, use_bin_type=True, default=_default), 0
+
+    def deserialize(self, key, value, flags):
+        return msgpack.unpackb(value, raw=False, ext_hook=_ext_hook)
+
+
+class TTLCache:
+    """ In-process TTL cache used when no memcached server is configured """
+
+    def __init__(self, ttl=86400, maxsize=100_000):
+        self.ttl = ttl
+        self._lock = Lock()
+        self._data = cachetools.TTLCache(maxsize=maxsize, ttl=ttl)
+
+    def __getitem__(self, key):
+        with self._lock:
+            return self._data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self._data[key]
+
+    def update(self, key, set_flags=0, clear_flags=0):
+        """ Atomically updates flag bits of the int stored at key """
+        with self._lock:
+            value = (self._data[key] | set_flags) & ~clear_flags
+            self._data[key] = value  # refresh the entry's TTL
+            return value
+
+    def expire(self):
+        """ Drops expired entries """
+        with self._lock:
+            self._data.expire()
 
 
 class Cache:
@@ -11,23 +71,52 @@ class Cache:
 
     def __init__(self, host="localhost", port=11211, ttl=86400):
         self.host = self.__class__.HOST or host
-        self.port = self.__class__.PORT or port
-        self.ttl = self.__class__.TTL or ttl
-        self.client = base.Client((self.host, self.port))
+        self.port = int(self.__class__.PORT or port)
+        self.ttl = int(self.__class__.TTL or ttl)
+        self.client = HashClient(
+            [(self.host, self.port)],
+            serde=MsgpackSerde(),
+            use_pooling=True,
+            max_pool_size=16,
+            no_delay=True,
+            connect_timeout=1,
+            timeout=1,
+            ignore_exc=True,
+        )
 
     def __getitem__(self, key):
         value = self.client.get(key)
-        if value:
-            return pickle.loads(value)
+        if value is not None:
+            return value
         else:
             raise KeyError
 
     def __setitem__(self, key, value):
-        self.client.set(key, pickle.dumps(value), expire=self.ttl)
+        self.client.set(key, value, expire=self.ttl)
 
     def __delitem__(self, key):
         value = self.client.get(key)
-        if value:
+        if value is not None:
             self.client.delete(key)
         else:
             raise KeyError
+
+    def update(self, key, set_flags=0, clear_flags=0):
+        """ Atomically updates flag bits of the int stored at key using cas """
+        while True:
+            # gets returns bare None (not a tuple) when memcached is down
+            # and ignore_exc swallows the error, so treat both as a miss
+            result = self.client.gets(key)
+            if not result or result[0] is None:
+                raise KeyError
+            value, token = result
+            value = (value | set_flags) & ~clear_flags
+            if self.client.cas(key, value, token, expire=self.ttl):
+                return value
+
+
+def create_cache(ttl=86400):
+    """ Returns a memcached-backed Cache if one is configured, else a TTLCache """
+    if Cache.HOST:
+        return Cache(ttl=ttl)
+    return TTLCache(ttl=ttl)
@@ -1,26 +1,33 @@
 import datetime
+import gzip
 import re
 import secrets
-import shutil
 import tempfile
 from pathlib import Path
 from typing import Optional
 
-from fastapi import Body, Depends, FastAPI, File, HTTPException, UploadFile
+from fastapi import Body, Depends, FastAPI, File, HTTPException, Request, UploadFile
 from fastapi.staticfiles import StaticFiles
 from fastapi.responses import StreamingResponse, HTMLResponse, JSONResponse
 from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
 
 from . import crud, models, schemas
 from .database import engine
 from .utils import (
+    TASK_ASSIGNED,
+    TASK_PAUSED,
+    build_archive,
     cache,
     file_downloader,
     file_remover,
     file_streamer,
+    find_files,
+    forget_task,
     get_current_username,
     get_db,
-    modification_date,
+    invalidate_user,
+    update_task,
 )
 
 models.Base.metadata.create_all(bind=engine)
@@ -29,21 +36,30 @@ app = FastAPI()
 app.mount("/static", StaticFiles(directory="app/static"), name="static")
 
 validate_email = re.compile(r"(^[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+$)")
+SPOOLSIZE = 8 * 1024 * 1024
+index_html = b""
+index_html_gzip = b""
 
 @app.on_event("startup")
 def startup_event():
+    global index_html, index_html_gzip
     path = Path("app") / "data"
     if not path.is_dir():
         path.mkdir()
+    index_html = (Path("app") / "static" / "index.html").read_bytes()
+    index_html_gzip = gzip.compress(index_html, 9)
 
 
 @app.get("/", response_class=HTMLResponse)
-def index():
+def index(request: Request):
     """ Index page of the website """
-    index_path = Path("app") / "static" / "index.html"
-    with index_path.open("r") as f:
-        html = f.read()
-    return HTMLResponse(content=html, status_code=200)
+    if "gzip" in request.headers.get("accept-encoding", ""):
+        return HTMLResponse(
+            content=index_html_gzip,
+            status_code=200,
+            headers={"content-encoding": "gzip", "vary": "Accept-Encoding"},
+        )
+    return HTMLResponse(content=index_html, status_code=200)
 
 
 @app.post("/create_user/", response_model=schemas.User)
@@ -58,7 +74,9 @@ def create_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
         db_user = crud.get_user_by_email(db, email=user.email)
         if db_user:
             raise HTTPException(status_code=400, detail="Email already registered!")
-        return crud.create_user(db=db, user=user)
+        created = crud.create_user(db=db, user=user)
+        invalidate_user(user.email)
+        return created
     raise HTTPException(status_code=400, detail="Invalid email address!")
 
 
@@ -77,7 +95,7 @@ def read_user(user: models.User = Depends(get_current_username)):
 def create_task(user: models.User = Depends(get_current_username)):
     """ Creates a new task with random but unique task_id """
     task_id = secrets.token_urlsafe(16)
-    cache[task_id] = {"is_assigned": False, "is_paused": False}
+    cache[task_id] = 0
     return {"task_id": task_id}
 
 
@@ -98,9 +116,14 @@ def pause_task(task_id: str, user: models.User = Depends(get_current_username)):
             status_code=404,
             content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
-    if not current_state["is_paused"]:
-        current_state["is_paused"] = True
-        cache[task_id] = current_state
+    if not current_state & TASK_PAUSED:
+        try:
+            update_task(task_id, set_flags=TASK_PAUSED)
+        except KeyError:
+            return JSONResponse(
+                status_code=404,
+                content={"message": f"Task: {task_id} is aborted or invalid!"},
+            )
         return JSONResponse(
             status_code=200,
             content={"message": f"Task: {task_id} paused successfully!"},
@@ -128,9 +151,14 @@ def resume_task(task_id: str, user: models.User = Depends(get_current_username))
             status_code=404,
             content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
-    if current_state["is_paused"]:
-        current_state["is_paused"] = False
-        cache[task_id] = current_state
+    if current_state & TASK_PAUSED:
+        try:
+            update_task(task_id, clear_flags=TASK_PAUSED)
+        except KeyError:
+            return JSONResponse(
+                status_code=404,
+                content={"message": f"Task: {task_id} is aborted or invalid!"},
+            )
         return JSONResponse(
             status_code=200,
             content={"message": f"Task: {task_id} resumed successfully!"},
@@ -151,7 +179,7 @@ def resume_task(task_id: str, user: models.User = Depends(get_current_username))
 def abort_task(task_id: str, user: models.User = Depends(get_current_username)):
     """ Aborts requested task """
     try:
-        del cache[task_id]
+        forget_task(task_id)
         return JSONResponse(
             status_code=200,
             content={"message": f"Task: {task_id} aborted successfully!"},
@@ -171,7 +199,7 @@ def abort_task(task_id: str, user: models.User = Depends(get_current_username)):
         409: {"description": "Task is already assigned!", "model": schemas.Message},
     },
 )
-def upload_file(
+async def upload_file(
     task_id: str,
     file: UploadFile = File(...),
     user: models.User = Depends(get_current_username),
@@ -185,21 +213,26 @@ def upload_file(
             content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
 
-    if current_state["is_assigned"]:
+    if current_state & TASK_ASSIGNED:
         return JSONResponse(
             status_code=409,
             content={"message": f"Task: {task_id} is already assigned!"},
         )
-    current_state["is_assigned"] = True
-    cache[task_id] = current_state
+    try:
+        update_task(task_id, set_flags=TASK_ASSIGNED)
+    except KeyError:
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"Task: {task_id} is aborted or invalid!"},
+        )
 
     path = Path("app") / "data" / user.email
     if not path.is_dir():
         path.mkdir()
     path /= file.filename
-    file_downloader(file, path, task_id)
+    await file_downloader(file, path, task_id)
     try:
-        del cache[task_id]
+        forget_task(task_id)
         return JSONResponse(
             status_code=200,
             content={"message": f"File: {file.filename} uploaded successfully!"},
@@ -222,7 +255,7 @@ def upload_file(
         409: {"description": "Task is already assigned!", "model": schemas.Message},
     },
 )
-def download_file(
+async def download_file(
     task_id: str,
     filename: Optional[str] = "*",
     from_date: Optional[datetime.datetime] = None,
@@ -245,41 +278,30 @@ def download_file(
             content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
 
-    if current_state["is_assigned"]:
+    if current_state & TASK_ASSIGNED:
         return JSONResponse(
             status_code=409,
             content={"message": f"Task: {task_id} is already assigned!"},
         )
 
-    current_state["is_assigned"] = True
-    cache[task_id] = current_state
-
-    paths = Path(f"app/data/{user.email}/").glob(filename)
-    if from_date is None:
-        from_date = datetime.datetime.fromtimestamp(0)
-    if to_date is None:
-        to_date = datetime.datetime.now()
-
-    paths = list(
-        filter(
-            lambda filename: from_date <= modification_date(filename) <= to_date, paths
+    try:
+        update_task(task_id, set_flags=TASK_ASSIGNED)
+    except KeyError:
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
-    )
-    temp_dir = Path(tempfile.mkdtemp())
-    data_dir = temp_dir / "data"
-    data_dir.mkdir()
-    for path in paths:
-        dest = data_dir / path.name
-        shutil.copy(path, dest)
-    zipfile = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S")
-    shutil.make_archive(temp_dir / zipfile, "zip", temp_dir, "data")
-    zipfile = f"{zipfile}.zip"
-    filepath = temp_dir / zipfile
+
+    paths = find_files(Path("app") / "data" / user.email, filename, from_date, to_date)
+    spool = tempfile.SpooledTemporaryFile(max_size=SPOOLSIZE)
+    await run_in_threadpool(build_archive, spool, paths)
+    spool.seek(0)
+    zipname = datetime.datetime.now().strftime("%Y-%m-%dT%H-%M-%S.zip")
 
     return StreamingResponse(
-        file_streamer(filepath, temp_dir, task_id),
+        file_streamer(spool, task_id),
         media_type="application/octet-stream",
-        headers={"Content-Disposition": f"attachment;filename={zipfile}"},
+        headers={"Content-Disposition": f"attachment;filename={zipname}"},
     )
 
 
@@ -291,7 +313,7 @@ def download_file(
         409: {"description": "Task is already assigned!", "model": schemas.Message},
     },
 )
-def delete_file(
+async def delete_file(
     task_id: str,
     filename: Optional[str] = Body("*"),
     from_date: Optional[datetime.datetime] = Body(None),
@@ -314,29 +336,25 @@ def delete_file(
             content={"message": f"Task: {task_id} is aborted or invalid!"},
         )
 
-    if current_state["is_assigned"]:
+    if current_state & TASK_ASSIGNED:
         return JSONResponse(
             status_code=409,
             content={"message": f"Task: {task_id} is already assigned!"},
         )
 
-    current_state["is_assigned"] = True
-    cache[task_id] = current_state
-
-    paths = Path(f"app/data/{user.email}/").glob(filename)
-    if from_date is None:
-        from_date = datetime.datetime.fromtimestamp(0)
-    if to_date is None:
-        to_date = datetime.datetime.now()
-
-    paths = filter(
-        lambda filename: from_date <= modification_date(filename) <= to_date, paths
-    )
+    try:
+        update_task(task_id, set_flags=TASK_ASSIGNED)
+    except KeyError:
+        return JSONResponse(
+            status_code=404,
+            content={"message": f"Task: {task_id} is aborted or invalid!"},
+        )
 
-    file_remover(paths, task_id)
+    paths = find_files(Path("app") / "data" / user.email, filename, from_date, to_date)
+    await file_remover(paths, task_id)
 
     try:
-        del cache[task_id]
+        forget_task(task_id)
         return JSONResponse(
             status_code=200, content={"message": f"Files deleted successfully!"}
         )
@@ -1,23 +1,52 @@
+import asyncio
 import datetime
+import fnmatch
 import os
+import re
 import secrets
-import shutil
+import zipfile
+from hashlib import blake2b
 from pathlib import Path
-from time import sleep
-from typing import Iterable
+from threading import Lock
+from time import time
+from typing import BinaryIO, Iterator, NamedTuple, Optional
+
+import aiofiles
+import cachetools
 
 from fastapi import Depends, HTTPException, UploadFile, status
 from fastapi.security import HTTPBasic, HTTPBasicCredentials
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
 
 from . import crud
-from .cache import Cache
+from .cache import create_cache
 from .database import SessionLocal
 
+try:
+    # SIMD-accelerated deflate and crc32, 2-3x faster than stdlib zlib;
+    # zipfile binds crc32 at import time so it must be patched separately
+    from isal import isal_zlib
+
+    zipfile.zlib = isal_zlib
+    zipfile.crc32 = isal_zlib.crc32
+except ImportError:
+    pass
+
 security = HTTPBasic()
-cache = Cache()
+cache = create_cache()
+AUTH_TTL = 60
+auth_cache = create_cache(ttl=AUTH_TTL)
+AUTH_SECRET = secrets.token_bytes(32)
 SLEEPTIME = 2
-CHUNKSIZE = 10000
+DOWNLOAD_CHUNKSIZE = 1 << 20
+UPLOAD_CHUNKSIZE = 1 << 16
+TASK_SYNC_INTERVAL = 8
+TASK_ASSIGNED = 1
+TASK_PAUSED = 2
+# mirror entries expire with the cached task so orphans cannot pile up
+local_tasks = cachetools.TTLCache(maxsize=100_000, ttl=cache.ttl)
+local_tasks_lock = Lock()
 
 
 def get_db():
@@ -28,10 +57,60 @@ def get_db():
         db.close()
 
 
+class CachedUser(NamedTuple):
+    id: int
+    email: str
+    is_active: bool
+    hashed_password: str
+
+
+def get_cached_user(db: Session, email: str) -> Optional[CachedUser]:
+    """ Fetches the user record for email through a short-TTL cache """
+    key = f"user:{email}"
+    try:
+        return CachedUser(**auth_cache[key])
+    except KeyError:
+        pass
+    db_user = crud.get_user(db, email=email)
+    if db_user is None:
+        return None
+    user = CachedUser(
+        id=db_user.id,
+        email=db_user.email,
+        is_active=db_user.is_active,
+        hashed_password=db_user.hashed_password,
+    )
+    auth_cache[key] = user._asdict()
+    return user
+
+
+def invalidate_user(email: str):
+    """ Drops the cached record for email after a user change """
+    try:
+        del auth_cache[f"user:{email}"]
+    except KeyError:
+        pass
+
+
+def auth_key(credentials: HTTPBasicCredentials) -> str:
+    """ Returns a keyed hash of the credentials usable as a cache key """
+    digest = blake2b(
+        f"{credentials.username}:{credentials.password}".encode(),
+        key=AUTH_SECRET,
+        digest_size=16,
+    ).hexdigest()
+    return f"auth:{digest}"
+
+
 def get_current_username(
     credentials: HTTPBasicCredentials = Depends(security), db: Session = Depends(get_db)
 ):
-    db_user = crud.get_user(db, email=credentials.username)
+    key = auth_key(credentials)
+    try:
+        return CachedUser(**auth_cache[key])
+    except KeyError:
+        pass
+    db_user = get_cached_user(db, email=credentials.username)
     if db_user is None:
         raise HTTPException(status_code=404, detail="User not found")
     correct_username = secrets.compare_digest(credentials.username, db_user.email)
@@ -45,64 +124,155 @@ def get_current_username(
             headers={"WWW-Authenticate": "Basic"},
         )
 
+    auth_cache[key] = db_user._asdict()
     return db_user
 
 
-def modification_date(filename):
-    t = os.path.getmtime(filename)
-    return datetime.datetime.fromtimestamp(t)
+def find_files(
+    directory: Path,
+    pattern: str,
+    from_date: Optional[datetime.datetime] = None,
+    to_date: Optional[datetime.datetime] = None,
+) -> Iterator[os.DirEntry]:
+    """ Yields files of directory matching pattern, modified within date range """
+    match = re.compile(fnmatch.translate(pattern)).match
+    from_ts = from_date.timestamp() if from_date else 0.0
+    to_ts = to_date.timestamp() if to_date else time()
+    try:
+        entries = os.scandir(directory)
+    except FileNotFoundError:
+        return
+    with entries:
+        for entry in entries:
+            if (
+                match(entry.name)
+                and entry.is_file()
+                and from_ts <= entry.stat().st_mtime <= to_ts
+            ):
+                yield entry
+
+
+def drop_local_task(task_id: str):
+    """ Drops the task from the process-local mirror """
+    with local_tasks_lock:
+        local_tasks.pop(task_id, None)
+
+
+def task_state(task_id: str, sync: bool = True):
+    """ Returns the task's state from the cache or the process-local mirror """
+    if not sync:
+        try:
+            with local_tasks_lock:
+                return local_tasks[task_id]
+        except KeyError:
+            pass
+    try:
+        state = cache[task_id]
+    except KeyError:
+        drop_local_task(task_id)
+        raise
+    with local_tasks_lock:
+        local_tasks[task_id] = state
+    return state
+
+
+def update_task(task_id: str, set_flags: int = 0, clear_flags: int = 0):
+    """ Updates the task's cached state flags and the local mirror """
+    state = cache.update(task_id, set_flags=set_flags, clear_flags=clear_flags)
+    with local_tasks_lock:
+        local_tasks[task_id] = state
+    return state
+
 
+def forget_task(task_id: str):
+    """ Drops the task from the cache and the local mirror """
+    drop_local_task(task_id)
+    del cache[task_id]
 
-def file_streamer(filepath: Path, temp_dir: Path, task_id: str):
+
+def build_archive(fileobj: BinaryIO, entries: Iterator[os.DirEntry]):
+    """ Writes entries into a zip archive on fileobj under a data/ prefix """
+    with zipfile.ZipFile(
+        fileobj, "w", zipfile.ZIP_DEFLATED, compresslevel=1
+    ) as archive:
+        for entry in entries:
+            archive.write(entry.path, f"data/{entry.name}")
+
+
+async def file_streamer(fileobj: BinaryIO, task_id: str):
     is_completed = False
-    with filepath.open("rb") as f:
-        while True:
-            try:
-                current_state = cache[task_id]
-            except KeyError:
-                break
-            if current_state["is_paused"]:
-                sleep(SLEEPTIME)
-            else:
-                chunk = f.read(CHUNKSIZE)
-                if chunk:
-                    yield chunk
-                else:
-                    is_completed = True
+    iterations = 0
+    try:
+        with fileobj as f:
+            while True:
+                try:
+                    current_state = task_state(
+                        task_id, sync=iterations % TASK_SYNC_INTERVAL == 0
+                    )
+                except KeyError:
                     break
-    shutil.rmtree(temp_dir)
+                iterations += 1
+                if current_state & TASK_PAUSED:
+                    iterations = 0
+                    await asyncio.sleep(SLEEPTIME)
+                else:
+                    chunk = await run_in_threadpool(f.read, DOWNLOAD_CHUNKSIZE)
+                    if chunk:
+                        yield chunk
+                    else:
+                        is_completed = True
+                        break
+    finally:
+        # a client disconnect exits here via GeneratorExit
+        drop_local_task(task_id)
     if is_completed:
-        del cache[task_id]
+        forget_task(task_id)
 
 
-def file_downloader(file: UploadFile, filepath: Path, task_id: str):
-    with filepath.open("wb") as f:
+async def file_downloader(file: UploadFile, filepath: Path, task_id: str):
+    iterations = 0
+    try:
+        async with aiofiles.open(filepath, "wb") as f:
+            while True:
+                try:
+                    current_state = task_state(
+                        task_id, sync=iterations % TASK_SYNC_INTERVAL == 0
+                    )
+                except KeyError:
+                    break
+                iterations += 1
+                if current_state & TASK_PAUSED:
+                    iterations = 0
+                    await asyncio.sleep(SLEEPTIME)
+                else:
+                    chunk = await file.read(UPLOAD_CHUNKSIZE)
+                    if chunk:
+                        await f.write(chunk)
+                    else:
+                        break
+    finally:
+        drop_local_task(task_id)
+
+
+async def file_remover(paths: Iterator[os.DirEntry], task_id: str):
+    iterations = 0
+    try:
         while True:
             try:
-                current_state = cache[task_id]
+                current_state = task_state(
+                    task_id, sync=iterations % TASK_SYNC_INTERVAL == 0
+                )
             except KeyError:
                 break
-            if current_state["is_paused"]:
-                sleep(SLEEPTIME)
+            iterations += 1
+            if current_state & TASK_PAUSED:
+                iterations = 0
+                await asyncio.sleep(SLEEPTIME)
             else:
-                chunk = file.file.read(CHUNKSIZE)
-                if chunk:
-                    f.write(chunk)
-                else:
+                try:
+                    entry = next(paths)
+                    await run_in_threadpool(os.unlink, entry.path)
+                except StopIteration:
                     break
-
-
-def file_remover(paths: Iterable[Path], task_id: str):
-    while True:
-        try:
-            current_state = cache[task_id]
-        except KeyError:
-            break
-        if current_state["is_paused"]:
-            sleep(SLEEPTIME)
-        else:
-            try:
-                path = next(paths)
-                path.unlink()
-            except StopIteration:
-                break
+    finally:
+        drop_local_task(task_id)